@@ -1,26 +1,100 @@
 import dash_bootstrap_components as dbc
 from dash import Dash, dcc, html
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
+import pyarrow.dataset as ds
+import pyarrow.feather
+import pyarrow.fs
 from dash.dependencies import Output, Input
+import functools
+import numpy as np
 import os
 
 # Dark theme by default
 pio.templates.default = "plotly_dark"
 
 necessary_columns = ['year', 'type_of_violence', 'region', 'latitude', 'longitude', 'deaths_a', 'deaths_b', 'deaths_civilians', 'best', 'conflict_name', 'country']
-df = pd.read_parquet('combined_ged_event_data.parquet', engine='pyarrow', columns=necessary_columns)
+parquet_path = 'combined_ged_event_data.parquet'
+feather_path = 'combined_ged_event_data.feather'
 
+violence_type_labels = {
+    1: 'State-based conflict',
+    2: 'Non-state conflict',
+    3: 'One-sided violence'
+}
+
+
+def preprocess_events():
+    # Memory-mapped read of just the needed columns; self_destruct releases the Arrow buffers while converting
+    events = ds.dataset(parquet_path, format='parquet', filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+    events_df = events.to_table(columns=necessary_columns, use_threads=True).to_pandas(self_destruct=True,
+                                                                                       split_blocks=True)
+
+    # Compact dtypes (halves the memory every filter and aggregation has to scan):
+    death_columns = ['deaths_a', 'deaths_b', 'deaths_civilians', 'best']
+    if events_df[death_columns].to_numpy().max() > np.iinfo(np.int32).max:
+        raise ValueError('Death counts do not fit into int32')
+    events_df = events_df.astype({'year': 'int16', 'type_of_violence': 'int8',
+                                  'deaths_a': 'int32', 'deaths_b': 'int32', 'deaths_civilians': 'int32',
+                                  'best': 'int32', 'latitude': 'float32', 'longitude': 'float32',
+                                  'region': 'category', 'country': 'category', 'conflict_name': 'category'})
+
+    # Decades (stored as the decade's first year, formatted only for display):
+    events_df['decade'] = (events_df['year'].to_numpy() // 10 * 10).astype(np.int16)
+
+    # Violence type labels for the map hover text:
+    events_df['violence_label'] = events_df['type_of_violence'].map(violence_type_labels).astype('category')
+    return events_df.reset_index(drop=True)
+
+
+# The preprocessed frame is cached as uncompressed Feather and rebuilt whenever the parquet (or this module) is newer
+if os.path.exists(feather_path) and os.path.getmtime(feather_path) >= max(os.path.getmtime(parquet_path),
+                                                                          os.path.getmtime(__file__)):
+    df = pyarrow.feather.read_table(feather_path, memory_map=True).to_pandas()
+else:
+    df = preprocess_events()
+    tmp_path = f'{feather_path}.{os.getpid()}.tmp'
+    try:
+        df.to_feather(tmp_path, compression='uncompressed')
+        os.replace(tmp_path, feather_path)
+    except OSError:
+        # The cache is only an optimisation, keep serving from the in-memory frame (e.g. read-only directory)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Row positions per filter value, so callbacks intersect small index arrays instead of building masks
+def build_row_index(values):
+    categorical = pd.Categorical(values)
+    codes = categorical.codes
+    return {value: np.flatnonzero(codes == i) for i, value in enumerate(categorical.categories)}
+
+
+no_rows = np.array([], dtype=np.intp)
+year_index = build_row_index(df['year'])
+decade_index = build_row_index(df['decade'])
+region_index = build_row_index(df['region'])
+violence_index = build_row_index(df['type_of_violence'])
+region_codes = df['region'].cat.codes.to_numpy()
+
+# Death counts per category as one contiguous array, summed row-wise in a single pass
+death_categories = {
+    'deaths_a': 'Side A Deaths',
+    'deaths_b': 'Side B Deaths',
+    'deaths_civilians': 'Civilian Deaths'
+}
+deaths_arr = np.ascontiguousarray(df[list(death_categories)].to_numpy())
 
-# Decades function
-def create_decade(year):
-    return f'{(year // 10) * 10}s'
-df['decade'] = df['year'].apply(create_decade)
+# (year, conflict) pairs packed into one int64, so unique conflicts per year need a single np.unique.
+# A missing conflict name (code -1) is masked to missing_conflict instead of sign-extending over the year.
+missing_conflict = 0xffffffff
+year_conflict_pairs = ((df['year'].to_numpy().astype(np.int64) << 32) |
+                       (df['conflict_name'].cat.codes.to_numpy().astype(np.int64) & missing_conflict))
 
 # Filters:
 available_years = ['All'] + sorted(df['year'].unique())
-available_decades = ['All'] + sorted(df['decade'].unique())
+available_decades = ['All'] + sorted(np.unique(df['decade']).tolist())
 available_regions = ['All'] + sorted(df['region'].unique())
 available_types_of_violence = {
     'All': 'All Types',
@@ -29,12 +103,6 @@ available_types_of_violence = {
     3: 'One-sided violence'
 }
 
-violence_type_labels = {
-    1: 'State-based conflict',
-    2: 'Non-state conflict',
-    3: 'One-sided violence'
-}
-
 app = Dash(__name__, external_stylesheets=[dbc.themes.CYBORG])
 server = app.server
 
@@ -59,7 +127,8 @@ app.layout = dbc.Container([
         dbc.Col([
             html.Label("Select Decade", id='decade-label', style={'color': 'white'}),
             dcc.Dropdown(id='decade-filter',
-                         options=[{'label': decade, 'value': decade} for decade in available_decades],
+                         options=[{'label': decade if decade == 'All' else f'{decade}s', 'value': decade}
+                                  for decade in available_decades],
                          value='All', clearable=False)
         ], width=3),
         dbc.Col([
@@ -109,6 +178,70 @@ def update_theme(is_dark):
     return page_style, text_style, text_style, text_style, text_style, text_style
 
 
+# Filtering, returns the selected row positions (shared between callbacks, must not be mutated):
+@functools.lru_cache(maxsize=16)
+def _filter(years_key, decade, region, violence):
+    selections = []
+    if 'All' not in years_key:
+        # Each row has a single year, so the union of the year selections is a sorted concatenation
+        selections.append(np.sort(np.concatenate([no_rows] + [year_index.get(year, no_rows) for year in years_key])))
+    if decade != 'All':
+        selections.append(decade_index.get(decade, no_rows))
+    if region != 'All':
+        selections.append(region_index.get(region, no_rows))
+    if violence != 'All':
+        selections.append(violence_index.get(violence, no_rows))
+    if not selections:
+        return slice(None)
+    return functools.reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), selections)
+
+
+# Map points, capped by a region-stratified sample so the browser payload stays bounded:
+max_map_points = 5000
+
+
+@functools.lru_cache(maxsize=16)
+def _map_points(years_key, decade, region, violence):
+    rows = np.arange(len(df))[_filter(years_key, decade, region, violence)]
+    if len(rows) > max_map_points:
+        # Each region keeps its share of the cap, but at least one point so it stays on the map and legend
+        rng = np.random.default_rng(0)
+        row_regions = region_codes[rows]
+        samples = []
+        for code in np.unique(row_regions):
+            region_rows = rows[row_regions == code]
+            size = min(len(region_rows), max_map_points * len(region_rows) // len(rows) + 1)
+            samples.append(rng.choice(region_rows, size, replace=False))
+        rows = np.sort(np.concatenate(samples))
+    return df.take(rows)
+
+
+# Figure shells (layouts are built once per theme, callbacks only fill in the data):
+def build_layouts(**layout):
+    return {is_dark: go.Layout(template='plotly_dark' if is_dark else 'plotly', **layout) for is_dark in (True, False)}
+
+
+time_series_layouts = build_layouts(title='Number of Unique Conflicts Over Years',
+                                    xaxis=dict(title='Year', tickmode='linear'),
+                                    yaxis=dict(title='Number of Unique Conflicts'),
+                                    legend=dict(tracegroupgap=0))
+pie_chart_layouts = build_layouts(title='Distribution of Deaths by Category', legend=dict(tracegroupgap=0))
+event_map_layouts = {
+    is_dark: go.Layout(title='Geographical Distribution of Conflict Events', height=600,
+                       mapbox=dict(zoom=1, style='carto-darkmatter' if is_dark else 'carto-positron'),
+                       legend=dict(title='region', tracegroupgap=0, itemsizing='constant'),
+                       paper_bgcolor='rgba(0,0,0,0)' if is_dark else 'rgba(255,255,255,1)',
+                       template='plotly_dark' if is_dark else 'plotly')
+    for is_dark in (True, False)
+}
+death_colors = ['#A9A9A9', '#2F4F4F', '#DC143C']
+map_marker_max_size = 20
+map_hovertemplate = ("<b>Country: %{hovertext}</b><br>" +
+                     "Year: %{customdata[0]}<br>" +
+                     "Type of Violence: %{customdata[1]}<br>" +
+                     "Most Likely Deaths: %{marker.size}<br>")
+
+
 # Callback graphs:
 @app.callback(
     [Output('time-series-graph', 'figure'),
@@ -121,57 +254,41 @@ def update_theme(is_dark):
      Input('theme-switch', 'value')]
 )
 def update_graphs(selected_years, selected_decade, selected_region, selected_violence_type, is_dark):
-    template = 'plotly_dark' if is_dark else 'plotly'
-    filtered_df = df.copy()
-    if 'All' not in selected_years:
-        filtered_df = filtered_df[filtered_df['year'].isin(selected_years)]
-    if selected_decade != 'All':
-        filtered_df = filtered_df[filtered_df['decade'] == selected_decade]
-    if selected_region != 'All':
-        filtered_df = filtered_df[filtered_df['region'] == selected_region]
-    if selected_violence_type != 'All':
-        filtered_df = filtered_df[filtered_df['type_of_violence'] == selected_violence_type]
+    # Theme toggles re-run this callback, so the filtering is cached on the filter values only
+    filters = (tuple(sorted(selected_years, key=str)), selected_decade, selected_region, selected_violence_type)
+    rows = _filter(*filters)
 
     # Line graph
-    conflicts_per_year = filtered_df.groupby('year')['conflict_name'].nunique().reset_index(
-        name='unique_conflict_count')
-    time_series_fig = px.line(conflicts_per_year, x='year', y='unique_conflict_count',
-                              title='Number of Unique Conflicts Over Years',
-                              labels={'year': 'Year', 'unique_conflict_count': 'Number of Unique Conflicts'},
-                              template=template)
-    time_series_fig.update_layout(xaxis=dict(tickmode='linear'))
+    pairs = np.unique(year_conflict_pairs[rows])
+    conflict_years, unique_conflict_counts = np.unique(pairs >> 32, return_counts=True)
+    # Like nunique, missing conflict names are not counted (their year still shows up)
+    unique_conflict_counts -= np.isin(conflict_years, pairs[(pairs & missing_conflict) == missing_conflict] >> 32)
+    time_series_fig = go.Figure(data=[go.Scatter(
+        x=conflict_years, y=unique_conflict_counts, mode='lines', showlegend=False,
+        hovertemplate='Year=%{x}<br>Number of Unique Conflicts=%{y}<extra></extra>')],
+        layout=time_series_layouts[is_dark])
 
     # Pie Chart
-    total_deaths = filtered_df[['deaths_a', 'deaths_b', 'deaths_civilians']].sum().reset_index()
-    total_deaths.columns = ['death_type', 'death_count']
-    total_deaths['death_type'] = total_deaths['death_type'].map({
-        'deaths_a': 'Side A Deaths',
-        'deaths_b': 'Side B Deaths',
-        'deaths_civilians': 'Civilian Deaths'
-    })
-    pie_chart_fig = px.pie(total_deaths, values='death_count', names='death_type',
-                           title='Distribution of Deaths by Category',
-                           color='death_type', color_discrete_map={
-            'Side A Deaths': '#A9A9A9',
-            'Side B Deaths': '#2F4F4F',
-            'Civilian Deaths': '#DC143C'
-        }, template=template)
-    pie_chart_fig.update_traces(textinfo='label+percent', showlegend=True)
-
-    # Map
-    filtered_df['type_of_violence'] = filtered_df['type_of_violence'].map(violence_type_labels)
-    event_map_fig = px.scatter_mapbox(filtered_df, lat='latitude', lon="longitude", size="best", color="region",
-                                      hover_name="country",
-                                      hover_data={"year": True, "type_of_violence": True, "best": ':.0f'},
-                                      zoom=1, height=600, title="Geographical Distribution of Conflict Events",
-                                      mapbox_style="carto-darkmatter" if is_dark else "carto-positron",
-                                      template=template)
-    event_map_fig.update_layout(paper_bgcolor='rgba(0,0,0,0)' if is_dark else 'rgba(255,255,255,1)')
-    event_map_fig.update_traces(
-        hovertemplate="<b>Country: %{hovertext}</b><br>" +
-                      "Year: %{customdata[0]}<br>" +
-                      "Type of Violence: %{customdata[1]}<br>" +
-                      "Most Likely Deaths: %{marker.size}<br>")
+    pie_chart_fig = go.Figure(data=[go.Pie(
+        labels=list(death_categories.values()), values=deaths_arr[rows].sum(axis=0),
+        marker=dict(colors=death_colors), textinfo='label+percent', showlegend=True,
+        hovertemplate='death_type=%{label}<br>death_count=%{value}<extra></extra>')],
+        layout=pie_chart_layouts[is_dark])
+
+    # Map (one trace per region, coloured in order of appearance like plotly express)
+    map_points = _map_points(*filters)
+    colorway = event_map_layouts[is_dark].template.layout.colorway
+    sizeref = max(map_points['best'].max(), 1) / map_marker_max_size ** 2 if len(map_points) else 1
+    event_map_fig = go.Figure(data=[go.Scattermapbox(
+        lat=points['latitude'], lon=points['longitude'], mode='markers', name=region, legendgroup=region,
+        marker=dict(size=points['best'], sizemode='area', sizeref=sizeref, color=colorway[i % len(colorway)]),
+        hovertext=points['country'], customdata=np.column_stack([points['year'], points['violence_label']]),
+        hovertemplate=map_hovertemplate)
+        for i, (region, points) in enumerate(map_points.groupby('region', observed=True, sort=False))],
+        layout=event_map_layouts[is_dark])
+    if len(map_points):
+        event_map_fig.update_layout(mapbox_center=dict(lat=map_points['latitude'].mean(),
+                                                       lon=map_points['longitude'].mean()))
 
     return time_series_fig, pie_chart_fig, event_map_fig
 